@@ -11,21 +11,27 @@ Purpose:
 Basic Usage:
   python pycolorscad.py --input your_model.scad --output combined.3mf
   
-  - Uses multiple threads to render each color-based .3mf in parallel.
+  - Uses multiple processes to render and parse each color-based .3mf in parallel.
   - Then merges them into a single .3mf with accurate color assignments.
 
 Dependencies:
-  - pip install lib3mf matplotlib
+  - pip install lib3mf matplotlib numpy
 
 """
 
 import os
 import re
+import mmap
+import ctypes
 import sys
+import shutil
 import argparse
 import subprocess
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from html import escape
+from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 import lib3mf # https://pypi.org/project/lib3mf/
 from matplotlib.colors import to_rgba
 
@@ -52,21 +58,32 @@ LINUX_DEFAULT_PATHS = [
     "/snap/bin/openscad-nightly",
 ]
 
+# Smallest plausible .3mf (zip container + content types + rels + model); anything smaller is skipped
+MIN_3MF_BYTES = 1024
+
+# Looks for color("red") or color("blue"), capturing the color text inside quotes.
+_COLOR_RE = re.compile(rb'color\s*\(\s*[\'"]([^\'"]+)[\'"]\s*\)') #"
+
 def _test_openscad_single(path_candidate):
     """
-    Try running `path_candidate --version`.
-    Return True if successful, otherwise False.
+    Resolve `path_candidate` (PATH lookup, ~ expansion) and try running it with `--version`.
+    Return the resolved path if successful, otherwise None.
+    Candidates that are not an executable file are rejected without spawning a process.
     """
+    resolved = shutil.which(os.path.expanduser(path_candidate))
+    if not resolved:
+        return None
     try:
         subprocess.run(
-            [path_candidate, "--version"],
-            capture_output=True,
-            text=True,
-            check=True
+            [resolved, "--version"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+            timeout=5
         )
-        return True
-    except (FileNotFoundError, subprocess.CalledProcessError):
-        return False
+        return resolved
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return None
         
 def find_working_openscad_path(user_path=None):
     """
@@ -76,8 +93,9 @@ def find_working_openscad_path(user_path=None):
 
     # 1. If user specified a path, test that first
     if user_path:
-        if _test_openscad_single(user_path):
-            return user_path
+        resolved = _test_openscad_single(user_path)
+        if resolved:
+            return resolved
         else:
             print(f"WARNING: OpenSCAD not found or invalid at '{user_path}'. Trying defaults...")
 
@@ -91,8 +109,9 @@ def find_working_openscad_path(user_path=None):
 
     # 3. Try each default path in turn
     for candidate in default_paths:
-        if _test_openscad_single(candidate):
-            return candidate
+        resolved = _test_openscad_single(candidate)
+        if resolved:
+            return resolved
 
     # 4. No success => instruct user to specify manually
     print("ERROR: Could not find a working OpenSCAD path.\n")
@@ -102,15 +121,75 @@ def find_working_openscad_path(user_path=None):
         print(f"  {c}")
     sys.exit(1)
 
+def _enable_features(help_text):
+    """
+    Return the experimental feature names listed under `--enable` in `openscad --help`,
+    e.g. "--enable arg   enable experimental features (...): lazy-union | manifold | ...".
+    The list may wrap over several lines and ends at the next option.
+    """
+    match = re.search(r'--enable\b[^:]*:(.*?)(?=\n\s*-|\Z)', help_text, re.S)
+    if not match:
+        return set()
+    return {f.strip() for f in match.group(1).split("|") if f.strip()}
+
+def openscad_backend_args(openscad_path, backend, warn=True):
+    """
+    Return the OpenSCAD command line flags that select the given CSG backend (e.g. "manifold").
+    Support is detected from `openscad --help`: newer builds take --backend=<name>, older nightlies
+    only offer Manifold as the experimental --enable=manifold feature, and stable releases take neither.
+    If unsupported, return no flags (warning only when warn is set).
+    """
+    if not backend:
+        return []
+    try:
+        result = subprocess.run(
+            [openscad_path, "--help"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            timeout=5
+        )
+        help_text = result.stdout
+    except (OSError, subprocess.TimeoutExpired):
+        help_text = ""
+
+    if "--backend" in help_text:
+        return [f"--backend={backend}"]
+    if backend.lower() == "cgal":
+        return [] # Builds without --backend always render with CGAL
+    if backend.lower() == "manifold" and "manifold" in _enable_features(help_text):
+        return ["--enable=manifold"]
+    if warn:
+        print(f"WARNING: '{openscad_path}' does not support the '{backend}' backend. Using the OpenSCAD default.")
+    return []
+
+def _backend_in_user_args(user_args):
+    """
+    Return True if the pass-through OpenSCAD args already select a CSG backend:
+    --backend[=...], or --enable manifold / --enable=manifold (or "all").
+    """
+    for i, arg in enumerate(user_args):
+        if arg == "--backend" or arg.startswith("--backend="):
+            return True
+        if arg.startswith("--enable="):
+            feature = arg.split("=", 1)[1]
+        elif arg == "--enable" and i + 1 < len(user_args):
+            feature = user_args[i + 1]
+        else:
+            continue
+        if feature in ("manifold", "all"):
+            return True
+    return False
+
 def extract_colors(scad_file):
     """
     Extract unique color names from lines containing `color()`.
+    The file is memory-mapped and scanned in one pass, so large .scad files are never fully read into memory.
     """
-    with open(scad_file, 'r', encoding='utf-8') as file:
-        content = file.read()
-    # Looks for color("red") or color("blue"), capturing the color text inside quotes.
-    pattern = r'color\s*\(\s*[\'"]([^\'"]+)[\'"]\s*\)' #"
-    colors = set(re.findall(pattern, content))
+    colors = set()
+    if os.path.getsize(scad_file) > 0: # mmap cannot map an empty file
+        with open(scad_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            colors = {m.group(1).decode('utf-8') for m in _COLOR_RE.finditer(mm)}
     if not colors:
         print(f"No color() calls found in '{scad_file}'.")
         sys.exit(1)
@@ -118,15 +197,17 @@ def extract_colors(scad_file):
 
 def generate_3mf_for_color(color_name, scad_file, openscad_path, user_args):
     """
-    Run OpenSCAD with a custom definition of color() that only renders shapes if str(c) == color_name.
+    Run OpenSCAD with a custom definition of color() that only renders shapes if c == color_name.
     """
     filename = f"{color_name}.3mf"
     print(f"Generating {filename} for color '{color_name}'...")
 
-    # Re-define color(c) so that it only renders the child objects if c matches color_name
+    # Re-define color(c) so that it only renders the child objects if c matches color_name.
+    # c is always a string literal at the call sites extract_colors() finds, so no str() cast is needed.
+    # color_name is the raw text between the quotes, so it is already a valid string literal body.
     redefine_color = (
         'module color(c) {'
-        f' if (str(c)==\"{color_name}\") children();'
+        f' if (c==\"{color_name}\") children();'
         '}'
     )
 
@@ -140,16 +221,14 @@ def generate_3mf_for_color(color_name, scad_file, openscad_path, user_args):
 
     return filename
 
-def rotate_indices(triangle):
+def rotate_indices(indices):
     """
-    Rotate triangle indices so the smallest index is first, matching typical 3mfmerge.exe logic for consistent ordering.
+    Rotate each row of an (N, 3) triangle index array so the smallest index is first, matching typical 3mfmerge.exe logic for consistent ordering.
     """
-    idx = list(triangle.Indices)
-    if idx[1] < idx[0] and idx[1] < idx[2]:
-        idx = [idx[1], idx[2], idx[0]]
-    elif idx[2] < idx[0] and idx[2] < idx[1]:
-        idx = [idx[2], idx[0], idx[1]]
-    return lib3mf.Triangle(Indices=(idx[0], idx[1], idx[2]))
+    k = indices.argmin(axis=1)
+    rows = np.arange(len(indices))[:, None]
+    cols = (k[:, None] + np.arange(3)) % 3
+    return indices[rows, cols]
 
 def parse_color_from_filename(fname):
     """
@@ -165,9 +244,86 @@ def parse_color_from_filename(fname):
         r, g, b, a = (0, 0, 0, 1)
     return (r, g, b, a, color_name)
 
-def merge_3mf_files(input_files, output_file):
+def _read_mesh_arrays(wrapper, mesh_obj):
+    """
+    Read a mesh's vertices and triangles as (N, 3) float32 / uint32 NumPy arrays.
+    The binding's GetVertices/GetTriangleIndices build one Python object per element, so the C getters are
+    called directly into preallocated ctypes buffers, which NumPy then views without copying.
+    """
+    vert_buf = (lib3mf.Position * mesh_obj.GetVertexCount())()
+    tri_buf = (lib3mf.Triangle * mesh_obj.GetTriangleCount())()
+    needed = ctypes.c_uint64(0)
+    wrapper.checkError(mesh_obj, wrapper.lib.lib3mf_meshobject_getvertices(
+        mesh_obj._handle, ctypes.c_uint64(len(vert_buf)), needed, vert_buf
+    ))
+    wrapper.checkError(mesh_obj, wrapper.lib.lib3mf_meshobject_gettriangleindices(
+        mesh_obj._handle, ctypes.c_uint64(len(tri_buf)), needed, tri_buf
+    ))
+    verts = np.frombuffer(vert_buf, dtype=np.float32).reshape(-1, 3)
+    tris = np.frombuffer(tri_buf, dtype=np.uint32).reshape(-1, 3)
+    return verts, tris
+
+def _to_ctypes_array(struct_type, arr, dtype):
+    """
+    Copy an (N, 3) NumPy array into a contiguous ctypes array of lib3mf structs (Position/Triangle) in one memcpy,
+    ready to pass to the lib3mf C API.
+    """
+    arr = np.ascontiguousarray(arr, dtype=dtype)
+    return (struct_type * len(arr)).from_buffer_copy(arr)
+
+def _extract_mesh_data(fname, canonical_order=False):
+    """
+    Load a color-specific .3mf and return (meshes, rgba, color_name), where meshes is a list of
+    (verts, tris) NumPy arrays. If canonical_order is set, triangles are rotated & sorted.
+    Runs in a worker process, so only picklable data is returned (no lib3mf handles).
+    """
+    r, g, b, a, color_name = parse_color_from_filename(fname)
+    meshes = []
+
+    # Load the sub-model
+    wrapper = lib3mf.Wrapper()
+    sub_model = wrapper.CreateModel()
+    reader = sub_model.QueryReader("3mf")
+    try:
+        reader.ReadFromFile(fname)
+    except lib3mf.ELib3MFException as e:
+        print(f"Error reading '{fname}': {e}")
+        return meshes, (r, g, b, a), color_name
+
+    mesh_iter = sub_model.GetMeshObjects()
+    while mesh_iter.MoveNext():
+        mesh_obj = mesh_iter.GetCurrentMeshObject()
+
+        verts, idx = _read_mesh_arrays(wrapper, mesh_obj)
+
+        # Optional: rotate & sort triangles for consistent ordering (byte-compatible with 3mfmerge.exe)
+        if canonical_order:
+            idx = rotate_indices(idx)
+            idx = idx[np.lexsort((idx[:, 2], idx[:, 1], idx[:, 0]))]
+
+        meshes.append((verts, idx))
+
+    return meshes, (r, g, b, a), color_name
+
+def render_and_parse(color_name, scad_file, openscad_path, user_args, canonical_order=False):
+    """
+    Render one color with OpenSCAD, parse the resulting .3mf and delete it, all in the same worker.
+    Returns the picklable (meshes, rgba, color_name) tuple from _extract_mesh_data.
     """
-    Load each color-specific .3mf, assign the appropriate color, and merge them into a single 3MF using lib3mf.
+    filename = generate_3mf_for_color(color_name, scad_file, openscad_path, user_args)
+    try:
+        # OpenSCAD can exit successfully yet leave a missing or truncated file; fail fast instead of parsing it
+        if not os.path.isfile(filename) or os.path.getsize(filename) < MIN_3MF_BYTES:
+            raise ValueError(f"OpenSCAD produced an empty or truncated '{filename}'")
+        return _extract_mesh_data(filename, canonical_order)
+    finally:
+        with suppress(OSError):
+            os.unlink(filename)
+
+def merge_3mf_files(parsed_data, output_file):
+    """
+    Assign each parsed color its color group and merge all meshes into a single 3MF using lib3mf.
+    parsed_data is an iterable of (meshes, rgba, color_name) tuples as returned by render_and_parse.
     """
     wrapper = lib3mf.Wrapper()
     merged_model = wrapper.CreateModel()
@@ -176,41 +332,26 @@ def merge_3mf_files(input_files, output_file):
 
     id_to_name = {}
 
-    for fname in input_files:
-        r, g, b, a, color_name = parse_color_from_filename(fname)
+    # A single color group holds one color per .3mf
+    color_group = merged_model.AddColorGroup()
+    color_group_id = color_group.GetResourceID()
 
-        # Create a color group for each .3mf
-        color_group = merged_model.AddColorGroup()
+    for meshes, (r, g, b, a), color_name in parsed_data:
         color_handle = color_group.AddColor(wrapper.FloatRGBAToColor(r, g, b, a))
 
-        # Load the sub-model
-        sub_model = wrapper.CreateModel()
-        reader = sub_model.QueryReader("3mf")
-        try:
-            reader.ReadFromFile(fname)
-        except lib3mf.ELib3MFException as e:
-            print(f"Error reading '{fname}': {e}")
-            continue
-
-        obj_iter = sub_model.GetObjects()
-        while obj_iter.MoveNext():
-            obj = obj_iter.GetCurrentObject()
-            if not obj or not obj.IsMeshObject():
-                continue
-
-            mesh_id = obj.GetResourceID()
-            mesh_obj = sub_model.GetMeshObjectByID(mesh_id)
-
-            verts = mesh_obj.GetVertices()
-            tris = mesh_obj.GetTriangleIndices()
-
-            # Rotate & sort triangles for consistent ordering
-            rotated_tris = [rotate_indices(t) for t in tris]
-            rotated_tris.sort(key=lambda tri: (tri.Indices[0], tri.Indices[1], tri.Indices[2]))
+        for verts, idx in meshes:
+            positions = _to_ctypes_array(lib3mf.Position, verts, np.float32)
+            triangles = _to_ctypes_array(lib3mf.Triangle, idx, np.uint32)
 
+            # The binding's SetGeometry re-unpacks its arguments element by element, so hand the
+            # contiguous arrays straight to the C entry point instead
             new_mesh = merged_model.AddMeshObject()
-            new_mesh.SetGeometry(verts, rotated_tris)
-            new_mesh.SetObjectLevelProperty(color_group.GetResourceID(), color_handle)
+            wrapper.checkError(new_mesh, wrapper.lib.lib3mf_meshobject_setgeometry(
+                new_mesh._handle,
+                ctypes.c_uint64(len(positions)), positions,
+                ctypes.c_uint64(len(triangles)), triangles
+            ))
+            new_mesh.SetObjectLevelProperty(color_group_id, color_handle)
             new_mesh.SetName(color_name)
 
             component = merged_components.AddComponent(new_mesh, identity)
@@ -221,22 +362,21 @@ def merge_3mf_files(input_files, output_file):
 
     # Optional: Bambu/Orca slicer metadata attachment
     attachment = merged_model.AddAttachment("Metadata/model_settings.config", "")
-    xml = [
-        '<?xml version="1.0" encoding="UTF-8"?>',
-        '<config>',
-        f'  <object id="{build_item.GetObjectResourceID()}">'
-    ]
-    def xml_escape(s):
-        return (s.replace("&", "&amp;").replace("\"", "&quot;"))
-
-    for comp_id, comp_name in id_to_name.items():
-        esc_name = xml_escape(comp_name)
-        xml.append(f'    <part id="{comp_id}" subtype="normal_part">')
-        xml.append(f'      <metadata key="name" value="{esc_name}"/>')
-        xml.append('    </part>')
-    xml.append('  </object>')
-    xml.append('</config>')
-    attachment.ReadFromBuffer(bytearray("\n".join(xml), encoding='utf-8'))
+    parts = "".join(
+        f'    <part id="{comp_id}" subtype="normal_part">\n'
+        f'      <metadata key="name" value="{escape(comp_name, quote=True)}"/>\n'
+        '    </part>\n'
+        for comp_id, comp_name in id_to_name.items()
+    )
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<config>\n'
+        f'  <object id="{build_item.GetObjectResourceID()}">\n'
+        f'{parts}'
+        '  </object>\n'
+        '</config>'
+    )
+    attachment.ReadFromBuffer(xml.encode('utf-8'))
 
     writer = merged_model.QueryWriter("3mf")
     writer.WriteToFile(output_file)
@@ -248,12 +388,23 @@ def main():
     parser.add_argument("-i", "--input", required=True,   help="Original .scad file")
     parser.add_argument("-o", "--output",                 help="Final .3mf filename")
     parser.add_argument("--openscad",                     help="Path to the OpenSCAD executable")
-    parser.add_argument("--threads", type=int, default=4, help="Number of threads to use for parallel rendering")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Number of worker processes to use for parallel rendering (default: CPU count)")
+    parser.add_argument("--openscad-backend", help="OpenSCAD CSG backend, e.g. manifold or cgal (default: manifold, if supported). Pass an empty string to use the OpenSCAD default")
+    parser.add_argument("--canonical-order", action="store_true", help="Rotate & sort triangles to match 3mfmerge.exe output ordering")
     args, user_args = parser.parse_known_args() #capture unexpected args as user args to pass to OpenSCAD
 
     # Find a working OpenSCAD path
     openscad_path = find_working_openscad_path(args.openscad)
 
+    # Select the CSG backend, unless the args passed through to OpenSCAD already choose one.
+    # Without --openscad-backend, use Manifold if this build has it and stay quiet otherwise.
+    if not _backend_in_user_args(user_args):
+        if args.openscad_backend is None:
+            backend_args = openscad_backend_args(openscad_path, "manifold", warn=False)
+        else:
+            backend_args = openscad_backend_args(openscad_path, args.openscad_backend)
+        user_args = [*backend_args, *user_args]
+
     # Ensure .scad file exists
     if not os.path.isfile(args.input):
         print(f"Error: Cannot find input file -i {args.input}")
@@ -264,35 +415,32 @@ def main():
     colors = extract_colors(scad_file)
     print(f"Found {len(colors)} color(s): {colors}")
 
-    # Step 2: For each color, override color() to filter only that color, saving one .3mf
-    temp_files = []
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+    # Step 2: For each color, override color() to filter only that color, then parse the .3mf in the same worker
+    parsed_data = []
+    # No more workers than colors; Windows caps ProcessPoolExecutor at 61 workers
+    workers = min(args.threads or os.cpu_count(), len(colors))
+    if sys.platform == "win32":
+        workers = min(workers, 61)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
         futures = {
-            executor.submit(generate_3mf_for_color, c, scad_file, openscad_path, user_args): c
+            executor.submit(render_and_parse, c, scad_file, openscad_path, user_args, args.canonical_order): c
             for c in colors
         }
         for fut in as_completed(futures):
             color = futures[fut]
             try:
-                temp_files.append(fut.result())
+                parsed_data.append(fut.result())
             except Exception as e:
                 print(f"Error generating '{color}.3mf': {e}")
 
-    # Step 3: Merge the .3mf files
+    # Step 3: Merge the parsed meshes (temporary .3mf files were already removed by the workers)
     if args.output:
         final_3mf = args.output
     else:
         base, _ = os.path.splitext(scad_file)
         final_3mf = f"{base}.3mf"
     print("Merging generated 3MF files...")
-    merge_3mf_files(temp_files, final_3mf)
-
-    # Step 4: Cleanup temporary 3MF files
-    for temp_file in temp_files:
-        try:
-            os.remove(temp_file)
-        except OSError:
-            pass
+    merge_3mf_files(parsed_data, final_3mf)
 
     print(f"Done! Merged file is '{final_3mf}'")
 